@@ -0,0 +1,232 @@
+import os
+import sys
+import csv
+import json
+import argparse
+import asyncio
+import urllib.error
+from typing import List, Dict, Any, Optional
+
+from lego_alt_bot import (
+    REBRICKABLE_API_KEY,
+    BREAKER_RESET_TIMEOUT,
+    CircuitOpenError,
+    RateLimitedError,
+    get_alternates,
+    looks_like_set_num,
+    normalize_set_num,
+    retry_after,
+)
+
+CSV_FIELDS = [
+    "source_set",
+    "set_num",
+    "name",
+    "year",
+    "num_parts",
+    "designer_name",
+    "moc_has_building_instructions",
+    "moc_url",
+    "moc_img_url",
+]
+
+
+def read_set_nums(path: str) -> List[str]:
+    f = sys.stdin if path == "-" else open(path, "r", encoding="utf-8")
+    try:
+        result = []
+        seen = set()
+        for line in f:
+            set_num = normalize_set_num(line)
+            if not set_num or set_num in seen:
+                continue
+            if not looks_like_set_num(set_num):
+                print(f"skip: bad set number {set_num!r}", file=sys.stderr)
+                continue
+            seen.add(set_num)
+            result.append(set_num)
+        return result
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+
+def read_checkpoint(path: str) -> set:
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return {line.strip() for line in f if line.strip()}
+    except FileNotFoundError:
+        return set()
+
+
+def cache_path(cache_dir: str, set_num: str) -> str:
+    return os.path.join(cache_dir, f"{set_num}.json")
+
+
+def load_cached(cache_dir: Optional[str], set_num: str) -> Optional[List[Dict[str, Any]]]:
+    if not cache_dir:
+        return None
+    try:
+        with open(cache_path(cache_dir, set_num), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+    except json.JSONDecodeError:
+        return None
+
+
+def public_fields(model: Dict[str, Any]) -> Dict[str, Any]:
+    # поля с "_" — служебные (например, экранированный для Telegram текст)
+    return {k: v for k, v in model.items() if not k.startswith("_")}
+
+
+def save_cached(cache_dir: Optional[str], set_num: str, models: List[Dict[str, Any]]) -> None:
+    if not cache_dir:
+        return
+    tmp = cache_path(cache_dir, set_num) + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump([public_fields(m) for m in models], f, ensure_ascii=False)
+    os.replace(tmp, cache_path(cache_dir, set_num))
+
+
+async def fetch_set(set_num: str, cache_dir: Optional[str], retries: int) -> List[Dict[str, Any]]:
+    cached = load_cached(cache_dir, set_num)
+    if cached is not None:
+        return cached
+
+    attempt = 0
+    while True:
+        try:
+            # экспорт идёт по next до конца и без дублирующих запросов: важна квота, а не задержка;
+            # если страница не загрузилась, набор считается неудачным
+            models = await get_alternates(set_num, max_pages=None, hedge=False)
+            break
+        except RateLimitedError as e:
+            # другой воркер получил 429 — ждём конца окна, попытку не тратим
+            await asyncio.sleep(e.retry_after)
+            continue
+        except CircuitOpenError:
+            if attempt == retries:
+                raise
+            # API временно недоступен — ждём, пока circuit breaker пустит пробный запрос
+            await asyncio.sleep(BREAKER_RESET_TIMEOUT)
+        except urllib.error.HTTPError as e:
+            # 404 и прочие 4xx повтором не исправить; 429 ждём столько, сколько просит API
+            wait = retry_after(e)
+            if attempt == retries or (wait is None and e.code < 500):
+                raise
+            await asyncio.sleep(wait if wait is not None else 2 ** attempt)
+        except Exception:
+            if attempt == retries:
+                raise
+            await asyncio.sleep(2 ** attempt)
+        attempt += 1
+
+    save_cached(cache_dir, set_num, models)
+    return models
+
+
+class Writer:
+    """Пишет строки сразу по мере готовности наборов; набор попадает в checkpoint только после записи строк."""
+
+    def __init__(self, output: str, fmt: str, checkpoint: str):
+        new_file = not os.path.exists(output) or os.path.getsize(output) == 0
+        self._out = open(output, "a", encoding="utf-8", newline="")
+        self._checkpoint = open(checkpoint, "a", encoding="utf-8")
+        self._csv = None
+        if fmt == "csv":
+            self._csv = csv.DictWriter(self._out, fieldnames=CSV_FIELDS, extrasaction="ignore")
+            if new_file:
+                self._csv.writeheader()
+
+    def write(self, set_num: str, models: List[Dict[str, Any]]) -> None:
+        for m in models:
+            row = {"source_set": set_num, **public_fields(m)}
+            if self._csv is not None:
+                self._csv.writerow(row)
+            else:
+                self._out.write(json.dumps(row, ensure_ascii=False) + "\n")
+        self._out.flush()
+        self._checkpoint.write(set_num + "\n")
+        self._checkpoint.flush()
+
+    def close(self) -> None:
+        self._out.close()
+        self._checkpoint.close()
+
+
+async def export(
+    set_nums: List[str],
+    writer: Writer,
+    concurrency: int,
+    cache_dir: Optional[str],
+    retries: int,
+) -> int:
+    queue: asyncio.Queue = asyncio.Queue()
+    for set_num in set_nums:
+        queue.put_nowait(set_num)
+
+    failed = 0
+    done = 0
+
+    async def worker():
+        nonlocal failed, done
+        while True:
+            try:
+                set_num = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            try:
+                models = await fetch_set(set_num, cache_dir, retries)
+            except Exception as e:
+                failed += 1
+                print(f"error: {set_num}: {e}", file=sys.stderr)
+                continue
+            writer.write(set_num, models)
+            done += 1
+            if done % 100 == 0:
+                print(f"{done}/{len(set_nums)} sets exported", file=sys.stderr)
+
+    await asyncio.gather(*(worker() for _ in range(max(1, concurrency))))
+    print(f"{done}/{len(set_nums)} sets exported, {failed} failed", file=sys.stderr)
+    return failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export Rebrickable alternate builds for many LEGO sets.")
+    parser.add_argument("input", help="file with one set number per line (e.g. 77244-1), or - for stdin")
+    parser.add_argument("-o", "--output", required=True, help="output file (appended to on resume)")
+    parser.add_argument("-f", "--format", choices=("jsonl", "csv"), default=None,
+                        help="output format (default: by output file extension, else jsonl)")
+    parser.add_argument("-c", "--concurrency", type=int, default=4, help="parallel requests (default: 4)")
+    parser.add_argument("--checkpoint", default=None, help="file with finished set numbers (default: <output>.done)")
+    parser.add_argument("--cache-dir", default=".alt_cache", help="local cache of fetched sets ('' to disable)")
+    parser.add_argument("--retries", type=int, default=2, help="retries per set on API errors (default: 2)")
+    args = parser.parse_args()
+    if args.retries < 0:
+        parser.error("--retries must be >= 0")
+
+    if not REBRICKABLE_API_KEY:
+        raise RuntimeError("REBRICKABLE_API_KEY is missing. Set it as environment variable REBRICKABLE_API_KEY.")
+
+    fmt = args.format or ("csv" if args.output.lower().endswith(".csv") else "jsonl")
+    checkpoint = args.checkpoint or f"{args.output}.done"
+    if args.cache_dir:
+        os.makedirs(args.cache_dir, exist_ok=True)
+
+    finished = read_checkpoint(checkpoint)
+    set_nums = [s for s in read_set_nums(args.input) if s not in finished]
+    if finished:
+        print(f"resuming: {len(finished)} sets already exported", file=sys.stderr)
+
+    writer = Writer(args.output, fmt, checkpoint)
+    try:
+        failed = asyncio.run(export(set_nums, writer, args.concurrency, args.cache_dir or None, args.retries))
+    finally:
+        writer.close()
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
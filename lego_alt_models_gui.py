@@ -1,22 +1,38 @@
 import os
 import json
+import urllib.error
 import urllib.parse
 import urllib.request
 from typing import List, Dict, Any, Optional
 import asyncio
+import logging
+import math
+import re
+import string
+import sys
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 
 from telegram import (
     Update,
     InlineKeyboardButton,
     InlineKeyboardMarkup,
+    InputMediaPhoto,
+    Message,
 )
-from telegram.constants import ParseMode
+from telegram.constants import MessageLimit, ParseMode
+from telegram.error import BadRequest, Forbidden, TelegramError
+from telegram.helpers import escape_markdown
 from telegram.ext import (
     Application,
+    BaseUpdateProcessor,
     CommandHandler,
     CallbackQueryHandler,
     ContextTypes,
     MessageHandler,
+    TypeHandler,
     filters,
 )
 
@@ -27,9 +43,56 @@ BASE_URL = "https://rebrickable.com/api/v3"
 PAGE_SIZE_API = 50         
 PAGE_SIZE_UI = 5           
 PREFS_FILE = "user_prefs.json" 
+FILE_IDS_FILE = "file_ids.json"
+WATCHES_FILE = "watches.json"
+
+# таймаут одной попытки: зависший urlopen нельзя отменить, он держит поток пула до таймаута
+API_TIMEOUT = 8
+API_MAX_WORKERS = 16
+HEDGE_DEFAULT_DELAY = 1.5
+HEDGE_MIN_DELAY = 0.3
+HEDGE_MAX_DELAY = 5.0
+BREAKER_FAILURE_THRESHOLD = 5
+BREAKER_RESET_TIMEOUT = 30
+# пауза после 429, если Rebrickable не прислал Retry-After
+RATE_LIMIT_DEFAULT_WAIT = 10
+ALT_CACHE_TTL = 60 * 60
+ALT_CACHE_MAX_ITEMS = 500
+SET_CACHE_TTL = 7 * 24 * 60 * 60
+SET_CACHE_MAX_ITEMS = 5000
+FILE_IDS_MAX_ITEMS = 20000
+# бюджет на кэши и сессии; размер считается по sys.getsizeof (size_of), без накладных расходов аллокатора
+MEMORY_BUDGET_MB = int(os.getenv("MEMORY_BUDGET_MB", "64"))
+SESSION_TTL = 24 * 60 * 60
+MEMORY_SWEEP_INTERVAL = 5 * 60
+# команда -> {"user"/"chat": (ёмкость корзины, пополнение токенов в секунду)}
+THROTTLE_LIMITS = {
+    "alts": {"user": (5, 1 / 10), "chat": (20, 1 / 3)},
+    "text": {"user": (5, 1 / 10), "chat": (20, 1 / 3)},
+    # /watch при пустом кэше делает полный запрос к API
+    "watch": {"user": (3, 1 / 60), "chat": (10, 1 / 20)},
+    # кнопка под результатом, которого уже нет в ALT_CACHE, заново загружает весь список
+    "refetch": {"user": (5, 1 / 30), "chat": (20, 1 / 10)},
+    "gallery": {"user": (5, 1 / 10), "chat": (20, 1 / 3)},
+}
+THROTTLE_IDLE_TTL = 60 * 60
+THROTTLE_MAX_BUCKETS = 100_000
+WATCH_INTERVAL = 60 * 60
+MAX_WATCHES_PER_CHAT = 20
+NOTIFY_RATE = 20
+MAX_API_PAGES = 10
+PROGRESS_EDIT_INTERVAL = 1.0
+MAX_CONCURRENT_UPDATES = 16
+CALLBACK_VERSION = "r1"
+CALLBACK_MAX_BYTES = 64
+SORTS = ("d", "p", "n")
 
 BOT_TOKEN = os.getenv("BOT_TOKEN", "").strip()
 REBRICKABLE_API_KEY = os.getenv("REBRICKABLE_API_KEY", "").strip()
+# Telegram user id через запятую; только им доступна /stats
+ADMIN_IDS = {int(x) for x in os.getenv("ADMIN_IDS", "").replace(",", " ").split() if x.isdigit()}
+
+logger = logging.getLogger(__name__)
 
 
 # ==========================
@@ -54,8 +117,13 @@ TEXTS = {
         "fetching": "⏳ Ищу альтернативные модели для *{set_num}*…",
         "not_found": "😕 Для набора *{set_num}* альтернативные модели не найдены.",
         "error_api": "❌ Ошибка API: {msg}",
+        "throttled": "⏳ Слишком много запросов. Попробуй снова через {seconds} с.",
+        "loading": "⏳ Загружено {loaded} из {count}…",
+        "truncated": "ℹ️ Показаны первые {loaded} из {count}.",
+        "partial_error": "⚠️ Загружено {loaded} из {count}, остальное получить не удалось: {msg}",
         "error_keys": "❌ Не настроены ключи. Добавь `BOT_TOKEN` и `REBRICKABLE_API_KEY` в переменные окружения.",
-        "header": "🧱 *Альтернативные модели*\n📦 Набор: *{set_num}*\nПоказано: *{shown}* из *{total}* {filter_line}",
+        "header": "🧱 *Альтернативные модели*\n📦 Набор: *{set_num}*{set_line}\nПоказано: *{shown}* из *{total}* {filter_line}",
+        "set_line": "\n🏷 {name} • 📅 {year} • 🧩 {num_parts}",
         "filter_on": "• 📄 Фильтр: *только с PDF*",
         "filter_off": "• 📄 Фильтр: *все модели*",
         "item_pdf_yes": "📄 PDF: *есть*",
@@ -66,14 +134,29 @@ TEXTS = {
         "btn_toggle_pdf_off": "📄 Показать все",
         "btn_change_lang": "🌍 Сменить язык",
         "btn_open": "🔗 Открыть модель",
+        "btn_gallery": "🖼 Галерея",
+        "btn_sort": "↕️ Сортировка: {sort}",
+        "sort_d": "по умолчанию",
+        "sort_p": "по деталям",
+        "sort_n": "по названию",
+        "gallery_empty": "🖼 Для этой страницы нет изображений.",
+        "gallery_failed": "🖼 Telegram не принял изображения этой страницы, вот ссылки:",
         "lang_changed_ru": "✅ Язык установлен: Русский",
         "lang_changed_en": "✅ Language set: English",
         "help": (
             "Команды:\n"
             "• `/start` — меню\n"
             "• `/alts <set_num>` — поиск альтернатив (пример: `/alts 77244-1`)\n"
+            "• `/watch <set_num>` — следить за новыми альтернативами набора\n"
+            "• `/unwatch <set_num>` — перестать следить\n"
             "• `/lang` — выбрать язык\n"
         ),
+        "watch_usage": "👀 Укажи номер набора: `/watch 77244-1`",
+        "watch_added": "👀 Слежу за набором *{set_num}*. Напишу, когда появятся новые альтернативные модели.",
+        "watch_removed": "✅ Больше не слежу за набором *{set_num}*.",
+        "watch_limit": "🚫 В этом чате уже {limit} отслеживаемых наборов. Убери лишние через `/unwatch`.",
+        "watch_not_found": "😕 Набор *{set_num}* не найден на Rebrickable — следить не за чем.",
+        "watch_new": "🆕 Новые альтернативные модели для {set_num}:",
     },
     "en": {
         "start_title": "🧱 *LEGO Alternate Models Bot*",
@@ -93,8 +176,13 @@ TEXTS = {
         "fetching": "⏳ Searching alternate models for *{set_num}*…",
         "not_found": "😕 No alternate models found for *{set_num}*.",
         "error_api": "❌ API error: {msg}",
+        "throttled": "⏳ Too many requests. Try again in {seconds}s.",
+        "loading": "⏳ Loaded {loaded} of {count}…",
+        "truncated": "ℹ️ Showing the first {loaded} of {count}.",
+        "partial_error": "⚠️ Loaded {loaded} of {count}, failed to fetch the rest: {msg}",
         "error_keys": "❌ Keys are not configured. Add `BOT_TOKEN` and `REBRICKABLE_API_KEY` as environment variables.",
-        "header": "🧱 *Alternate models*\n📦 Set: *{set_num}*\nShowing: *{shown}* of *{total}* {filter_line}",
+        "header": "🧱 *Alternate models*\n📦 Set: *{set_num}*{set_line}\nShowing: *{shown}* of *{total}* {filter_line}",
+        "set_line": "\n🏷 {name} • 📅 {year} • 🧩 {num_parts}",
         "filter_on": "• 📄 Filter: *PDF only*",
         "filter_off": "• 📄 Filter: *all models*",
         "item_pdf_yes": "📄 PDF: *available*",
@@ -105,14 +193,29 @@ TEXTS = {
         "btn_toggle_pdf_off": "📄 Show all",
         "btn_change_lang": "🌍 Change language",
         "btn_open": "🔗 Open model",
+        "btn_gallery": "🖼 Gallery",
+        "btn_sort": "↕️ Sort: {sort}",
+        "sort_d": "default",
+        "sort_p": "by parts",
+        "sort_n": "by name",
+        "gallery_empty": "🖼 No images for this page.",
+        "gallery_failed": "🖼 Telegram rejected the images on this page, here are the links:",
         "lang_changed_ru": "✅ Язык установлен: Русский",
         "lang_changed_en": "✅ Language set: English",
         "help": (
             "Commands:\n"
             "• `/start` — menu\n"
             "• `/alts <set_num>` — search alternates (example: `/alts 77244-1`)\n"
+            "• `/watch <set_num>` — get notified about new alternates for a set\n"
+            "• `/unwatch <set_num>` — stop watching a set\n"
             "• `/lang` — choose language\n"
         ),
+        "watch_usage": "👀 Add a set number: `/watch 77244-1`",
+        "watch_added": "👀 Watching *{set_num}*. I'll message you when new alternate models appear.",
+        "watch_removed": "✅ No longer watching *{set_num}*.",
+        "watch_limit": "🚫 This chat already watches {limit} sets. Remove some with `/unwatch`.",
+        "watch_not_found": "😕 Set *{set_num}* was not found on Rebrickable, nothing to watch.",
+        "watch_new": "🆕 New alternate models for {set_num}:",
     },
 }
 
@@ -155,15 +258,448 @@ def t(user_id: int, key: str) -> str:
     return TEXTS[lang][key]
 
 
+def load_file_ids() -> "TTLCache":
+    # file_id не устаревают по времени, только вытесняются по LRU и бюджету памяти
+    cache = TTLCache(math.inf, FILE_IDS_MAX_ITEMS)
+    try:
+        with open(FILE_IDS_FILE, "r", encoding="utf-8") as f:
+            data = json.load(f)
+    except FileNotFoundError:
+        return cache
+    except json.JSONDecodeError:
+        return cache
+    for url, file_id in data.items():
+        cache.set(url, file_id)
+    return cache
+
+
+def save_file_ids(file_ids: "TTLCache") -> None:
+    with open(FILE_IDS_FILE, "w", encoding="utf-8") as f:
+        # порядок от давно не использованных к свежим — LRU переживает перезапуск
+        json.dump(dict(file_ids.items()), f, ensure_ascii=False, indent=2)
+
+
+def load_watches() -> Dict[str, Any]:
+    try:
+        with open(WATCHES_FILE, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except json.JSONDecodeError:
+        return {}
+
+
+def save_watches(watches: Dict[str, Any]) -> None:
+    with open(WATCHES_FILE, "w", encoding="utf-8") as f:
+        json.dump(watches, f, ensure_ascii=False, indent=2)
+
+
+# set_num -> {"chats": [chat_id, ...], "seen": [moc set_num, ...] | None}
+WATCHES = load_watches()
+
+
 # ==========================
 # Rebrickable API
 # ==========================
-def fetch_alternates(set_num: str, page_size: int = PAGE_SIZE_API) -> List[Dict[str, Any]]:
-    url = f"{BASE_URL}/lego/sets/{urllib.parse.quote(set_num)}/alternates/?page_size={page_size}"
+class CircuitOpenError(Exception):
+    pass
+
+
+class RateLimitedError(Exception):
+    """Недавно был 429: до конца окна Retry-After запросы к Rebrickable не отправляются."""
+
+    def __init__(self, retry_after: float):
+        super().__init__(f"Rebrickable rate limit, retry in {math.ceil(retry_after)}s")
+        self.retry_after = retry_after
+
+
+def size_of(value: Any) -> int:
+    """Память, занятая значением: sys.getsizeof по всем вложенным dict/list/tuple/set.
+
+    Общие объекты (например, одинаковые ключи словарей из одного JSON) считаются один раз.
+    """
+    seen = set()
+    size = 0
+    stack = [value]
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen:
+            continue
+        seen.add(id(obj))
+        size += sys.getsizeof(obj)
+        if isinstance(obj, dict):
+            stack.extend(obj.keys())
+            stack.extend(obj.values())
+        elif isinstance(obj, (list, tuple, set, frozenset)):
+            stack.extend(obj)
+    return size
+
+
+class TTLCache:
+    """LRU-кэш с TTL. Просроченные записи не удаляются сразу, чтобы их можно было отдать как stale."""
+
+    def __init__(self, ttl: float, max_items: int):
+        self.ttl = ttl
+        self.max_items = max_items
+        self.evictions = 0
+        self.bytes = 0
+        # key -> [stored_at, accessed_at, value, size]; порядок — от давно не использованных к свежим
+        self._data: "OrderedDict[str, list]" = OrderedDict()
+
+    def get(self, key: str, allow_stale: bool = False) -> Any:
+        item = self._data.get(key)
+        if item is None:
+            return None
+        now = time.monotonic()
+        if not allow_stale and now - item[0] > self.ttl:
+            return None
+        item[1] = now
+        self._data.move_to_end(key)
+        return item[2]
+
+    def set(self, key: str, value: Any) -> None:
+        old = self._data.pop(key, None)
+        if old is not None:
+            self.bytes -= old[3]
+        now = time.monotonic()
+        # у FILE_IDS ключ (URL изображения) длиннее самого значения
+        size = size_of(key) + size_of(value)
+        self._data[key] = [now, now, value, size]
+        self.bytes += size
+        while len(self._data) > self.max_items:
+            self.pop_oldest()
+
+    def pop(self, key: str) -> None:
+        item = self._data.pop(key, None)
+        if item is not None:
+            self.bytes -= item[3]
+
+    def items(self) -> List[tuple]:
+        return [(key, item[2]) for key, item in self._data.items()]
+
+    def oldest_access(self) -> Optional[float]:
+        if not self._data:
+            return None
+        return next(iter(self._data.values()))[1]
+
+    def pop_oldest(self) -> int:
+        _, item = self._data.popitem(last=False)
+        self.bytes -= item[3]
+        self.evictions += 1
+        return item[3]
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+class LatencyTracker:
+    def __init__(self, window: int = 200, min_samples: int = 20):
+        self.min_samples = min_samples
+        self._samples: deque = deque(maxlen=window)
+
+    def add(self, seconds: float) -> None:
+        self._samples.append(seconds)
+
+    def p95(self) -> Optional[float]:
+        if len(self._samples) < self.min_samples:
+            return None
+        ordered = sorted(self._samples)
+        return ordered[int(0.95 * (len(ordered) - 1))]
+
+    def hedge_delay(self) -> float:
+        p95 = self.p95()
+        if p95 is None:
+            return HEDGE_DEFAULT_DELAY
+        return max(HEDGE_MIN_DELAY, min(p95, HEDGE_MAX_DELAY))
+
+
+class CircuitBreaker:
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold: int, reset_timeout: float):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probe_in_flight = False
+        self.transitions: Dict[str, int] = {}
+
+    def _move(self, state: str) -> None:
+        key = f"{self.state}->{state}"
+        self.transitions[key] = self.transitions.get(key, 0) + 1
+        logger.warning("Circuit breaker: %s", key)
+        self.state = state
+
+    def allow(self) -> bool:
+        if self.state == self.OPEN:
+            if time.monotonic() - self.opened_at < self.reset_timeout:
+                return False
+            self._move(self.HALF_OPEN)
+        if self.state == self.HALF_OPEN:
+            # в half-open пропускаем только один пробный запрос
+            if self.probe_in_flight:
+                return False
+            self.probe_in_flight = True
+        return True
+
+    def record_success(self) -> None:
+        self.failures = 0
+        self.probe_in_flight = False
+        if self.state != self.CLOSED:
+            self._move(self.CLOSED)
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        self.probe_in_flight = False
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+            if self.state != self.OPEN:
+                self._move(self.OPEN)
+
+    def release(self) -> None:
+        """Запрос завершился, ничего не сказав о здоровье upstream (например, 404)."""
+        self.probe_in_flight = False
+
+
+ALT_CACHE = TTLCache(ALT_CACHE_TTL, ALT_CACHE_MAX_ITEMS)
+# метаданные наборов почти не меняются, поэтому у них отдельный долгоживущий кэш
+SET_CACHE = TTLCache(SET_CACHE_TTL, SET_CACHE_MAX_ITEMS)
+# image URL -> Telegram file_id: каждое изображение загружается в Telegram только один раз
+FILE_IDS = load_file_ids()
+LATENCY = LatencyTracker()
+BREAKER = CircuitBreaker(BREAKER_FAILURE_THRESHOLD, BREAKER_RESET_TIMEOUT)
+HEDGE_STATS = {
+    "requests": 0,
+    "hedged": 0,
+    "hedge_wins": 0,
+    "hedges_skipped": 0,
+    "stale_served": 0,
+    "rate_limited": 0,
+}
+# после 429 дублирующие запросы не отправляем до этого момента (time.monotonic())
+RATE_LIMITED_UNTIL = {"until": 0.0}
+
+# отдельный ограниченный пул для HTTP, чтобы зависшие запросы не занимали общий executor asyncio
+API_EXECUTOR = ThreadPoolExecutor(max_workers=API_MAX_WORKERS, thread_name_prefix="rebrickable")
+API_THREADS = {"busy": 0}
+API_THREADS_LOCK = threading.Lock()
+
+
+def alternates_url(set_num: str, page_size: int = PAGE_SIZE_API, page: int = 1) -> str:
+    return f"{BASE_URL}/lego/sets/{urllib.parse.quote(set_num)}/alternates/?page_size={page_size}&page={page}"
+
+
+def set_details_url(set_num: str) -> str:
+    return f"{BASE_URL}/lego/sets/{urllib.parse.quote(set_num)}/"
+
+
+def get_json(url: str) -> Dict[str, Any]:
     req = urllib.request.Request(url, headers={"Authorization": f"key {REBRICKABLE_API_KEY}"})
-    with urllib.request.urlopen(req, timeout=25) as resp:
-        data = json.loads(resp.read().decode("utf-8"))
-        return data.get("results", [])
+    with urllib.request.urlopen(req, timeout=API_TIMEOUT) as resp:
+        return json.loads(resp.read().decode("utf-8"))
+
+
+def fetch_alternates(set_num: str, page_size: int = PAGE_SIZE_API) -> List[Dict[str, Any]]:
+    return get_json(alternates_url(set_num, page_size)).get("results", [])
+
+
+def get_json_in_pool(url: str) -> Dict[str, Any]:
+    with API_THREADS_LOCK:
+        API_THREADS["busy"] += 1
+    try:
+        return get_json(url)
+    finally:
+        with API_THREADS_LOCK:
+            API_THREADS["busy"] -= 1
+
+
+def submit_get_json(url: str) -> asyncio.Future:
+    # отмена future снимает запрос из очереди пула, если поток его ещё не взял
+    return asyncio.get_running_loop().run_in_executor(API_EXECUTOR, get_json_in_pool, url)
+
+
+def is_upstream_failure(error: BaseException) -> bool:
+    """Сбой upstream — таймауты, сетевые ошибки, 5xx и 429. Остальные 4xx — ошибка самого запроса."""
+    if isinstance(error, urllib.error.HTTPError):
+        return error.code >= 500 or error.code == 429
+    return isinstance(error, OSError)
+
+
+def retry_after(error: BaseException) -> Optional[float]:
+    """Сколько секунд ждать по ответу 429 (заголовок Retry-After); None — это не 429."""
+    if not isinstance(error, urllib.error.HTTPError) or error.code != 429:
+        return None
+    value = (error.headers.get("Retry-After") if error.headers else None) or ""
+    return float(value) if value.strip().isdigit() else float(RATE_LIMIT_DEFAULT_WAIT)
+
+
+async def hedged_get_json(url: str, hedge: bool = True) -> Dict[str, Any]:
+    """GET через circuit breaker; если ответа нет дольше p95, отправляем дублирующий запрос.
+
+    hedge=False — без дублей, для пакетной выгрузки, где важна квота, а не задержка.
+    """
+    # после 429 не шлём ничего, пока не истечёт Retry-After, иначе окно только продлится
+    wait = RATE_LIMITED_UNTIL["until"] - time.monotonic()
+    if wait > 0:
+        raise RateLimitedError(wait)
+    if not BREAKER.allow():
+        raise CircuitOpenError("Rebrickable is temporarily unavailable, try again later")
+
+    HEDGE_STATS["requests"] += 1
+    started = time.monotonic()
+    primary = submit_get_json(url)
+    pending = {primary}
+    try:
+        done, pending = await asyncio.wait(pending, timeout=LATENCY.hedge_delay() if hedge else None)
+        if not done:
+            # при замедлении upstream пул забивается зависшими запросами — дубли тогда только мешают;
+            # после 429 дубли лишь продлевают ограничение
+            if API_THREADS["busy"] < API_MAX_WORKERS // 2 and time.monotonic() >= RATE_LIMITED_UNTIL["until"]:
+                HEDGE_STATS["hedged"] += 1
+                pending.add(submit_get_json(url))
+            else:
+                HEDGE_STATS["hedges_skipped"] += 1
+
+        error: Optional[BaseException] = None
+        while pending or done:
+            for task in done:
+                if task.exception() is None:
+                    if task is not primary:
+                        HEDGE_STATS["hedge_wins"] += 1
+                    LATENCY.add(time.monotonic() - started)
+                    BREAKER.record_success()
+                    return task.result()
+                error = task.exception()
+                wait = retry_after(error)
+                if wait is not None:
+                    HEDGE_STATS["rate_limited"] += 1
+                    RATE_LIMITED_UNTIL["until"] = max(RATE_LIMITED_UNTIL["until"], time.monotonic() + wait)
+            if not pending:
+                break
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+
+        if is_upstream_failure(error):
+            BREAKER.record_failure()
+        raise error
+    finally:
+        # в том числе при отмене вызывающей корутины: иначе half-open probe так и останется занятым
+        for task in pending:
+            task.cancel()
+        BREAKER.release()
+
+
+async def stream_alternates(
+    set_num: str,
+    first_page_size: int = PAGE_SIZE_UI,
+    refresh: bool = False,
+    max_pages: Optional[int] = MAX_API_PAGES,
+    hedge: bool = True,
+):
+    """Отдаёт (модели_на_текущий_момент, всего_в_API) по мере загрузки страниц.
+
+    Первый запрос маленький, чтобы первая страница UI появилась как можно раньше;
+    остальное догружается страницами по PAGE_SIZE_API. В кэш попадает только полный список
+    (или первые max_pages страниц; None — идти по next до конца); если страница не загрузилась,
+    поднимается исключение.
+    refresh=True игнорирует свежий кэш (stale всё равно отдаётся, если API недоступен).
+    В кэше вместе с моделями лежит count из API, чтобы обрезанный список не выдавал себя за полный.
+    """
+    cached = None if refresh else ALT_CACHE.get(set_num)
+    if cached is not None:
+        yield cached["models"], cached["count"]
+        return
+
+    try:
+        data = await hedged_get_json(alternates_url(set_num, first_page_size), hedge)
+    except Exception as e:
+        stale = ALT_CACHE.get(set_num, allow_stale=True)
+        # stale выручает только при сбое upstream; 404 значит, что набора больше нет
+        if stale is None or (isinstance(e, urllib.error.HTTPError) and not is_upstream_failure(e)):
+            raise
+        HEDGE_STATS["stale_served"] += 1
+        yield stale["models"], stale["count"]
+        return
+
+    models = ingest_models(data.get("results", []))
+    complete = not data.get("next")
+    # count из API учитывает дубликаты, которые мы отбрасываем; у полного списка всего — len(models)
+    total = len(models) if complete else data.get("count", len(models))
+    yield models, total
+
+    seen = {m.get("set_num") for m in models}
+    page = 2 if first_page_size == PAGE_SIZE_API else 1
+    while not complete and (max_pages is None or page <= max_pages):
+        # ошибка на следующих страницах пробрасывается: частичный список не должен выглядеть полным
+        data = await hedged_get_json(alternates_url(set_num, PAGE_SIZE_API, page), hedge)
+        fresh = ingest_models([m for m in data.get("results", []) if m.get("set_num") not in seen])
+        seen.update(m.get("set_num") for m in fresh)
+        models = models + fresh
+        complete = not data.get("next")
+        total = len(models) if complete else data.get("count", total)
+        page += 1
+        yield models, total
+
+    ALT_CACHE.set(set_num, {"models": models, "count": total})
+
+
+async def get_set_info(set_num: str) -> Optional[Dict[str, Any]]:
+    """Название, год и число деталей набора. Ошибки не пробрасываются: это только украшение заголовка."""
+    cached = SET_CACHE.get(set_num)
+    if cached is not None:
+        return cached
+
+    try:
+        data = await hedged_get_json(set_details_url(set_num))
+    except Exception:
+        return SET_CACHE.get(set_num, allow_stale=True)
+
+    info = ingest_set_info({key: data.get(key) for key in ("name", "year", "num_parts")})
+    SET_CACHE.set(set_num, info)
+    return info
+
+
+async def get_alternates_with_count(
+    set_num: str,
+    refresh: bool = False,
+    max_pages: Optional[int] = MAX_API_PAGES,
+    hedge: bool = True,
+) -> tuple:
+    """(модели, всего_в_API); всего > len(модели), если список обрезан на max_pages."""
+    models: List[Dict[str, Any]] = []
+    count = 0
+    async for models, count in stream_alternates(
+        set_num, first_page_size=PAGE_SIZE_API, refresh=refresh, max_pages=max_pages, hedge=hedge
+    ):
+        pass
+    return models, count
+
+
+async def get_alternates(
+    set_num: str,
+    refresh: bool = False,
+    max_pages: Optional[int] = MAX_API_PAGES,
+    hedge: bool = True,
+) -> List[Dict[str, Any]]:
+    models, _ = await get_alternates_with_count(set_num, refresh=refresh, max_pages=max_pages, hedge=hedge)
+    return models
+
+
+def api_stats() -> Dict[str, Any]:
+    return {
+        "breaker_state": BREAKER.state,
+        "breaker_transitions": dict(BREAKER.transitions),
+        "hedge_delay": round(LATENCY.hedge_delay(), 3),
+        "p95": LATENCY.p95(),
+        "api_threads_busy": API_THREADS["busy"],
+        **HEDGE_STATS,
+        "alt_cache_items": len(ALT_CACHE),
+        "alt_cache_evictions": ALT_CACHE.evictions,
+        "set_cache_items": len(SET_CACHE),
+        "set_cache_evictions": SET_CACHE.evictions,
+    }
 
 
 def normalize_set_num(raw: str) -> str:
@@ -181,51 +717,169 @@ def looks_like_set_num(s: str) -> bool:
 # ==========================
 # UI rendering
 # ==========================
+ITEM_TEMPLATE = "*{index}.* *{name}*\n👤 {designer} • 🧩 {parts}\n{instr}\n{url}"
+MD_V2_SPECIAL = re.compile(r"([_\[\]()~>#+\-=|{}.!\\])")
+
+
+def md(value: Any) -> str:
+    return escape_markdown(str(value), version=2)
+
+
+def compile_md_v2(template: str):
+    """Переводит шаблон из TEXTS (legacy Markdown) в MarkdownV2 и возвращает его str.format.
+
+    Статический текст экранируется один раз здесь; * и ` остаются разметкой,
+    а значения полей должны приходить уже экранированными (см. ingest_models).
+    """
+    out = []
+    for literal, field, _, _ in string.Formatter().parse(template):
+        out.append(MD_V2_SPECIAL.sub(r"\\\1", literal).replace("{", "{{").replace("}", "}}"))
+        if field is not None:
+            out.append("{" + field + "}")
+    return "".join(out).format
+
+
+def compile_templates(lang: str) -> Dict[str, Any]:
+    texts = TEXTS[lang]
+    templates = {
+        key: compile_md_v2(texts[key])
+        for key in ("header", "set_line", "filter_on", "filter_off", "loading", "truncated", "partial_error")
+    }
+    templates["item_pdf_yes"] = compile_md_v2(ITEM_TEMPLATE.replace("{instr}", texts["item_pdf_yes"]))
+    templates["item_pdf_no"] = compile_md_v2(ITEM_TEMPLATE.replace("{instr}", texts["item_pdf_no"]))
+    return templates
+
+
+RENDER_TEMPLATES = {lang: compile_templates(lang) for lang in TEXTS}
+
+
+def ingest_models(models: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Экранирует поля модели для MarkdownV2 один раз при получении из API, а не при каждом рендере."""
+    for m in models:
+        m["_md"] = {
+            "name": md(m.get("name") or "Unnamed"),
+            "designer": md(m.get("designer_name") or "Unknown"),
+            "parts": md(m.get("num_parts", "-")),
+            "url": md(m.get("moc_url") or ""),
+        }
+    return models
+
+
+def ingest_set_info(info: Dict[str, Any]) -> Dict[str, Any]:
+    info["_md"] = {key: md(info.get(key) or "-") for key in ("name", "year", "num_parts")}
+    return info
+
+
+def utf16_len(text: str) -> int:
+    """Длина так, как её считает Telegram: в UTF-16 code units (эмодзи 🧩 — это 2)."""
+    return len(text.encode("utf-16-le")) // 2
+
+
+def fit_message(header: str, blocks: List[str], footer: str) -> str:
+    """Собирает сообщение, отбрасывая последние карточки, если не влезаем в лимит Telegram."""
+    dropped = False
+    while True:
+        tail = (["…"] if dropped else []) + ([footer] if footer else [])
+        text = "\n\n".join([header, *blocks, *tail])
+        if utf16_len(text) <= MessageLimit.MAX_TEXT_LENGTH or not blocks:
+            return text
+        blocks = blocks[:-1]
+        dropped = True
+
+
 def format_page(
     user_id: int,
     set_num: str,
     models: List[Dict[str, Any]],
     page: int,
     pdf_only: bool,
+    progress: Optional[tuple] = None,
+    set_info: Optional[Dict[str, Any]] = None,
+    status: str = "loading",
+    error: str = "",
 ) -> str:
+    tpl = RENDER_TEMPLATES[get_lang(user_id)]
     total = len(models)
     start = page * PAGE_SIZE_UI
     end = min(start + PAGE_SIZE_UI, total)
     shown = end - start
 
-    filter_line = t(user_id, "filter_on") if pdf_only else t(user_id, "filter_off")
-    header = t(user_id, "header").format(set_num=set_num, shown=shown, total=total, filter_line=f"\n{filter_line}")
-
-    lines = [header, ""]
+    filter_line = tpl["filter_on"]() if pdf_only else tpl["filter_off"]()
+    set_line = ""
+    if set_info:
+        if "_md" not in set_info:
+            ingest_set_info(set_info)
+        set_line = tpl["set_line"](**set_info["_md"])
+    header = tpl["header"](
+        set_num=md(set_num), set_line=set_line, shown=shown, total=total, filter_line=f"\n{filter_line}"
+    )
 
+    blocks = []
     for i in range(start, end):
         m = models[i]
-        name = m.get("name", "Unnamed")
-        designer = m.get("designer_name", "Unknown")
-        parts = m.get("num_parts", "-")
-        has_instr = bool(m.get("moc_has_building_instructions"))
-        instr = t(user_id, "item_pdf_yes") if has_instr else t(user_id, "item_pdf_no")
-        url = m.get("moc_url", "")
-
-        lines.append(
-            f"*{i+1}.* *{name}*\n"
-            f"👤 {designer} • 🧩 {parts}\n"
-            f"{instr}\n"
-            f"{url}"
-        )
-        lines.append("")  
+        item = tpl["item_pdf_yes"] if m.get("moc_has_building_instructions") else tpl["item_pdf_no"]
+        if "_md" not in m:
+            ingest_models([m])
+        blocks.append(item(index=i + 1, **m["_md"]))
+
+    footer = ""
+    if progress is not None:
+        loaded, count = progress
+        footer = tpl[status](loaded=loaded, count=count, msg=md(error))
+
+    return fit_message(header, blocks, footer)
+
 
-    return "\n".join(lines).strip()
+def encode_view_token(action: str, set_num: str, page: int, pdf_only: bool, sort: str) -> str:
+    """Всё состояние просмотра хранится в callback_data; set_num — ключ результата в ALT_CACHE."""
+    token = f"{CALLBACK_VERSION}:{action}:{set_num}:{page}:{int(pdf_only)}{sort}"
+    if len(token.encode("utf-8")) > CALLBACK_MAX_BYTES:
+        raise ValueError(f"callback_data is longer than {CALLBACK_MAX_BYTES} bytes: {token}")
+    return token
 
 
-def build_nav_keyboard(user_id: int, page: int, total_pages: int, pdf_only: bool) -> InlineKeyboardMarkup:
-    btn_prev = InlineKeyboardButton(t(user_id, "btn_prev"), callback_data="nav:prev")
-    btn_next = InlineKeyboardButton(t(user_id, "btn_next"), callback_data="nav:next")
+def decode_view_token(data: str) -> Optional[tuple]:
+    parts = data.split(":")
+    if len(parts) != 5 or parts[0] != CALLBACK_VERSION:
+        return None
+    _, action, set_num, page, flags = parts
+    if action not in ("p", "g") or not looks_like_set_num(set_num) or not page.isdigit():
+        return None
+    if len(flags) != 2 or flags[0] not in "01" or flags[1] not in SORTS:
+        return None
+    return action, set_num, int(page), flags[0] == "1", flags[1]
+
+
+def build_nav_keyboard(
+    user_id: int,
+    set_num: str,
+    page: int,
+    total_pages: int,
+    pdf_only: bool,
+    sort: str,
+) -> InlineKeyboardMarkup:
+    btn_prev = InlineKeyboardButton(
+        t(user_id, "btn_prev"), callback_data=encode_view_token("p", set_num, page - 1, pdf_only, sort)
+    )
+    btn_next = InlineKeyboardButton(
+        t(user_id, "btn_next"), callback_data=encode_view_token("p", set_num, page + 1, pdf_only, sort)
+    )
 
     toggle_text = t(user_id, "btn_toggle_pdf_off") if pdf_only else t(user_id, "btn_toggle_pdf_on")
-    btn_toggle = InlineKeyboardButton(toggle_text, callback_data="filter:toggle")
+    btn_toggle = InlineKeyboardButton(
+        toggle_text, callback_data=encode_view_token("p", set_num, 0, not pdf_only, sort)
+    )
+
+    next_sort = SORTS[(SORTS.index(sort) + 1) % len(SORTS)]
+    btn_sort = InlineKeyboardButton(
+        t(user_id, "btn_sort").format(sort=t(user_id, f"sort_{sort}")),
+        callback_data=encode_view_token("p", set_num, 0, pdf_only, next_sort),
+    )
 
     btn_lang = InlineKeyboardButton(t(user_id, "btn_change_lang"), callback_data="lang:menu")
+    btn_gallery = InlineKeyboardButton(
+        t(user_id, "btn_gallery"), callback_data=encode_view_token("g", set_num, page, pdf_only, sort)
+    )
 
     row1 = []
     if page > 0:
@@ -236,7 +890,8 @@ def build_nav_keyboard(user_id: int, page: int, total_pages: int, pdf_only: bool
     keyboard = []
     if row1:
         keyboard.append(row1)
-    keyboard.append([btn_toggle, btn_lang])
+    keyboard.append([btn_toggle, btn_sort])
+    keyboard.append([btn_gallery, btn_lang])
 
     return InlineKeyboardMarkup(keyboard)
 
@@ -284,6 +939,85 @@ async def lang_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("Choose / Выбери:", reply_markup=build_lang_keyboard(user_id))
 
 
+async def stats_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # внутренняя статистика (кэши, подписки, breaker) — только для админов из ADMIN_IDS
+    if update.effective_user.id not in ADMIN_IDS:
+        return
+
+    stats = {
+        **api_stats(),
+        **memory_stats(context.application),
+        "throttle_buckets": len(THROTTLE),
+        "throttled": THROTTLE.rejected,
+        "watched_sets": len(WATCHES),
+        "watch_subscriptions": sum(len(w["chats"]) for w in WATCHES.values()),
+        **WATCH_STATS,
+    }
+    lines = [f"{key}: {value}" for key, value in stats.items()]
+    await update.message.reply_text("\n".join(lines))
+
+
+class TokenBuckets:
+    """Token bucket на ключ. Корзины лежат в OrderedDict по времени последнего обращения,
+    поэтому и доступ, и вытеснение простаивающих корзин — O(1)."""
+
+    def __init__(self, idle_ttl: float, max_buckets: int):
+        self.idle_ttl = idle_ttl
+        self.max_buckets = max_buckets
+        self.rejected = 0
+        self._buckets: "OrderedDict[tuple, list]" = OrderedDict()
+
+    def take(self, requests: List[tuple]) -> float:
+        """requests: [(key, (capacity, rate)), ...]. Токен списывается из всех корзин сразу
+        или ни из одной; возвращает 0 или число секунд до следующей попытки."""
+        now = time.monotonic()
+        while self._buckets:
+            key, (_, updated_at) = next(iter(self._buckets.items()))
+            if now - updated_at < self.idle_ttl and len(self._buckets) < self.max_buckets:
+                break
+            self._buckets.popitem(last=False)
+
+        levels = []
+        wait = 0.0
+        for key, (capacity, rate) in requests:
+            bucket = self._buckets.pop(key, None)
+            tokens = capacity if bucket is None else min(capacity, bucket[0] + (now - bucket[1]) * rate)
+            if tokens < 1:
+                wait = max(wait, (1 - tokens) / rate)
+            levels.append((key, tokens))
+
+        for key, tokens in levels:
+            self._buckets[key] = [tokens if wait else tokens - 1, now]
+        if wait:
+            self.rejected += 1
+        return wait
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+
+THROTTLE = TokenBuckets(THROTTLE_IDLE_TTL, THROTTLE_MAX_BUCKETS)
+
+
+async def throttled(update: Update, command: str) -> bool:
+    """Проверяет лимиты команды для пользователя и чата; при превышении отвечает, когда повторить."""
+    limits = THROTTLE_LIMITS.get(command)
+    if not limits:
+        return False
+
+    requests = [((command, "user", update.effective_user.id), limits["user"])]
+    if update.effective_chat:
+        requests.append(((command, "chat", update.effective_chat.id), limits["chat"]))
+
+    wait = THROTTLE.take(requests)
+    if not wait:
+        return False
+
+    user_id = update.effective_user.id
+    await update.effective_message.reply_text(t(user_id, "throttled").format(seconds=math.ceil(wait)))
+    return True
+
+
 async def alts_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
 
@@ -291,6 +1025,9 @@ async def alts_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text(t(user_id, "error_keys"))
         return
 
+    if await throttled(update, "alts"):
+        return
+
     if not context.args:
         await update.message.reply_text(t(user_id, "ask_set"), parse_mode=ParseMode.MARKDOWN)
         context.user_data["awaiting_set"] = True
@@ -306,11 +1043,73 @@ async def text_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not context.user_data.get("awaiting_set"):
         return
 
+    if await throttled(update, "text"):
+        return
+
     set_num = normalize_set_num(update.message.text)
     context.user_data["awaiting_set"] = False
     await run_search_and_show(update, context, set_num)
 
 
+async def watch_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    chat_id = update.effective_chat.id
+
+    if not context.args or not looks_like_set_num(normalize_set_num(context.args[0])):
+        await update.message.reply_text(t(user_id, "watch_usage"), parse_mode=ParseMode.MARKDOWN)
+        return
+
+    set_num = normalize_set_num(context.args[0])
+    watch = WATCHES.get(set_num)
+    if watch is None or chat_id not in watch["chats"]:
+        if await throttled(update, "watch"):
+            return
+        if sum(chat_id in w["chats"] for w in WATCHES.values()) >= MAX_WATCHES_PER_CHAT:
+            await update.message.reply_text(
+                t(user_id, "watch_limit").format(limit=MAX_WATCHES_PER_CHAT), parse_mode=ParseMode.MARKDOWN
+            )
+            return
+
+        seen = None
+        if watch is None or watch["seen"] is None:
+            # запоминаем текущие модели, чтобы первый опрос не прислал их как новые
+            try:
+                seen = [m.get("set_num") for m in await get_alternates(set_num)]
+            except urllib.error.HTTPError as e:
+                if e.code == 404:
+                    await update.message.reply_text(
+                        t(user_id, "watch_not_found").format(set_num=set_num), parse_mode=ParseMode.MARKDOWN
+                    )
+                    return
+            except Exception:
+                # API недоступен — seen заполнит первый опрос
+                pass
+
+        # за время запроса набор мог добавить кто-то ещё
+        watch = WATCHES.setdefault(set_num, {"chats": [], "seen": None})
+        if chat_id not in watch["chats"]:
+            watch["chats"].append(chat_id)
+        if watch["seen"] is None:
+            watch["seen"] = seen
+        save_watches(WATCHES)
+
+    await update.message.reply_text(t(user_id, "watch_added").format(set_num=set_num), parse_mode=ParseMode.MARKDOWN)
+
+
+async def unwatch_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    chat_id = update.effective_chat.id
+
+    if not context.args:
+        await update.message.reply_text(t(user_id, "watch_usage"), parse_mode=ParseMode.MARKDOWN)
+        return
+
+    set_num = normalize_set_num(context.args[0])
+    unsubscribe(set_num, chat_id)
+    save_watches(WATCHES)
+    await update.message.reply_text(t(user_id, "watch_removed").format(set_num=set_num), parse_mode=ParseMode.MARKDOWN)
+
+
 async def run_search_and_show(update: Update, context: ContextTypes.DEFAULT_TYPE, set_num: str):
     user_id = update.effective_user.id
 
@@ -318,25 +1117,78 @@ async def run_search_and_show(update: Update, context: ContextTypes.DEFAULT_TYPE
         await update.message.reply_text(t(user_id, "bad_set"), parse_mode=ParseMode.MARKDOWN)
         return
 
-    await update.message.reply_text(t(user_id, "fetching").format(set_num=set_num), parse_mode=ParseMode.MARKDOWN)
+    placeholder = await update.message.reply_text(
+        t(user_id, "fetching").format(set_num=set_num), parse_mode=ParseMode.MARKDOWN
+    )
+
+    # метаданные набора грузятся параллельно с альтернативами и не задерживают первую страницу
+    info_task = asyncio.create_task(get_set_info(set_num))
 
+    stream = stream_alternates(set_num)
     try:
-        models = fetch_alternates(set_num, page_size=PAGE_SIZE_API)
+        models, count = await stream.__anext__()
     except Exception as e:
-        await update.message.reply_text(t(user_id, "error_api").format(msg=str(e)))
+        info_task.cancel()
+        await placeholder.edit_text(t(user_id, "error_api").format(msg=str(e)))
         return
 
     if not models:
-        await update.message.reply_text(t(user_id, "not_found").format(set_num=set_num), parse_mode=ParseMode.MARKDOWN)
+        info_task.cancel()
+        await stream.aclose()
+        await placeholder.edit_text(t(user_id, "not_found").format(set_num=set_num), parse_mode=ParseMode.MARKDOWN)
         return
 
-    # по умолчанию показываем все, но запомним фильтр
-    context.user_data["set_num"] = set_num
-    context.user_data["all_models"] = models
-    context.user_data["pdf_only"] = False
-    context.user_data["page"] = 0
+    progress = (len(models), count) if count > len(models) else None
+    set_info = info_task.result() if info_task.done() else SET_CACHE.get(set_num)
+    await show_page(placeholder, user_id, set_num, models, 0, False, SORTS[0], progress, set_info)
+
+    # остальные страницы догружаются в фоне: обработчик не держит очередь апдейтов пользователя
+    # и слот воркера (PerUserUpdateProcessor), пока идёт загрузка
+    rendered = (len(models), progress, set_info)
+    context.application.create_task(
+        finish_search(placeholder, user_id, set_num, stream, info_task, models, count, rendered),
+        update=update,
+    )
+
+
+async def finish_search(
+    placeholder: Message,
+    user_id: int,
+    set_num: str,
+    stream,
+    info_task: asyncio.Task,
+    models: List[Dict[str, Any]],
+    count: int,
+    rendered: tuple,
+):
+    """Дочитывает stream_alternates, обновляя placeholder не чаще PROGRESS_EDIT_INTERVAL."""
+    last_edit = time.monotonic()
+    try:
+        async for models, count in stream:
+            if time.monotonic() - last_edit < PROGRESS_EDIT_INTERVAL:
+                continue
+            progress = (len(models), count) if count > len(models) else None
+            set_info = info_task.result() if info_task.done() else SET_CACHE.get(set_num)
+            await show_page(placeholder, user_id, set_num, models, 0, False, SORTS[0], progress, set_info)
+            rendered = (len(models), progress, set_info)
+            last_edit = time.monotonic()
+    except Exception as e:
+        set_info = info_task.result() if info_task.done() else SET_CACHE.get(set_num)
+        info_task.cancel()
+        # часть страниц уже показана — оставляем её, но честно сообщаем, что список неполный
+        await show_page(
+            placeholder, user_id, set_num, models, 0, False, SORTS[0],
+            (len(models), count), set_info, status="partial_error", error=str(e),
+        )
+        return
 
-    await show_current_page(update, context, edit=False)
+    set_info = await info_task
+    # count > len(models) здесь только если упёрлись в MAX_API_PAGES
+    progress = (len(models), count) if count > len(models) else None
+    if rendered != (len(models), progress, set_info) or progress:
+        await show_page(
+            placeholder, user_id, set_num, models, 0, False, SORTS[0], progress, set_info, status="truncated"
+        )
 
 
 def apply_filter(models: List[Dict[str, Any]], pdf_only: bool) -> List[Dict[str, Any]]:
@@ -345,44 +1197,114 @@ def apply_filter(models: List[Dict[str, Any]], pdf_only: bool) -> List[Dict[str,
     return [m for m in models if bool(m.get("moc_has_building_instructions"))]
 
 
-async def show_current_page(update: Update, context: ContextTypes.DEFAULT_TYPE, edit: bool):
-    user_id = update.effective_user.id
+def apply_sort(models: List[Dict[str, Any]], sort: str) -> List[Dict[str, Any]]:
+    if sort == "p":
+        return sorted(models, key=lambda m: m.get("num_parts") or 0, reverse=True)
+    if sort == "n":
+        return sorted(models, key=lambda m: str(m.get("name", "")).lower())
+    return models
 
-    set_num = context.user_data.get("set_num")
-    all_models = context.user_data.get("all_models", [])
-    pdf_only = bool(context.user_data.get("pdf_only"))
-    page = int(context.user_data.get("page", 0))
 
-    models = apply_filter(all_models, pdf_only)
+async def show_page(
+    message: Message,
+    user_id: int,
+    set_num: str,
+    all_models: List[Dict[str, Any]],
+    page: int,
+    pdf_only: bool,
+    sort: str,
+    progress: Optional[tuple] = None,
+    set_info: Optional[Dict[str, Any]] = None,
+    status: str = "loading",
+    error: str = "",
+):
+    """Рисует страницу результатов, редактируя message на месте.
+
+    progress=(загружено, всего) добавляет строку статуса: loading, truncated или partial_error.
+    Пока список грузится (status="loading"), кнопок нет: навигация появится вместе с полным списком.
+    """
+    models = apply_sort(apply_filter(all_models, pdf_only), sort)
     if not models:
         # если включили PDF-only и стало пусто
-        await (update.callback_query.message.edit_text if edit else update.effective_message.reply_text)(
-            t(user_id, "not_found").format(set_num=set_num),
-            parse_mode=ParseMode.MARKDOWN,
-        )
+        await message.edit_text(t(user_id, "not_found").format(set_num=set_num), parse_mode=ParseMode.MARKDOWN)
         return
 
     total_pages = (len(models) + PAGE_SIZE_UI - 1) // PAGE_SIZE_UI
     page = max(0, min(page, total_pages - 1))
-    context.user_data["page"] = page
 
-    text = format_page(user_id, set_num, models, page, pdf_only)
-    kb = build_nav_keyboard(user_id, page, total_pages, pdf_only)
+    text = format_page(user_id, set_num, models, page, pdf_only, progress, set_info, status, error)
+    loading = progress is not None and status == "loading"
+    kb = None if loading else build_nav_keyboard(user_id, set_num, page, total_pages, pdf_only, sort)
 
-    if edit:
-        await update.callback_query.message.edit_text(
-            text,
-            parse_mode=ParseMode.MARKDOWN,
-            reply_markup=kb,
-            disable_web_page_preview=True,
-        )
-    else:
-        await update.effective_message.reply_text(
+    try:
+        await message.edit_text(
             text,
-            parse_mode=ParseMode.MARKDOWN,
+            parse_mode=ParseMode.MARKDOWN_V2,
             reply_markup=kb,
             disable_web_page_preview=True,
         )
+    except BadRequest as e:
+        if "not modified" not in str(e).lower():
+            raise
+
+
+def build_gallery_media(models: List[Dict[str, Any]], page: int, use_file_ids: bool = True) -> tuple:
+    start = page * PAGE_SIZE_UI
+    urls = []
+    media = []
+    for i in range(start, min(start + PAGE_SIZE_UI, len(models))):
+        m = models[i]
+        url = m.get("moc_img_url")
+        if not url:
+            continue
+        cached = FILE_IDS.get(url) if use_file_ids else None
+        caption = f"{i+1}. {m.get('name', 'Unnamed')}"
+        media.append(InputMediaPhoto(cached or url, caption=caption))
+        urls.append(url)
+    return urls, media
+
+
+async def send_gallery(update: Update, models: List[Dict[str, Any]], page: int):
+    user_id = update.effective_user.id
+    message = update.effective_message
+
+    urls, media = build_gallery_media(models, page)
+    if not media:
+        await message.reply_text(t(user_id, "gallery_empty"))
+        return
+
+    async def send(items: List[InputMediaPhoto]) -> list:
+        if len(items) == 1:
+            return [await message.reply_photo(items[0].media, caption=items[0].caption)]
+        return list(await message.reply_media_group(items))
+
+    changed = False
+    try:
+        sent = list(zip(urls, await send(media)))
+    except BadRequest:
+        # альбом отклоняется целиком из-за одного устаревшего file_id или битого URL —
+        # шлём по одной, забываем только отклонённые file_id и пропускаем битые URL
+        sent = []
+        for url, item in zip(urls, media):
+            cached = FILE_IDS.get(url)
+            for source in ([cached] if cached else []) + [url]:
+                try:
+                    sent.append((url, await message.reply_photo(source, caption=item.caption)))
+                    break
+                except BadRequest:
+                    if source == cached:
+                        FILE_IDS.pop(url)
+                        changed = True
+        if not sent:
+            lines = [t(user_id, "gallery_failed")] + [f"• {item.caption} — {url}" for url, item in zip(urls, media)]
+            await message.reply_text("\n".join(lines), disable_web_page_preview=True)
+
+    for url, msg in sent:
+        if msg.photo and FILE_IDS.get(url) != msg.photo[-1].file_id:
+            FILE_IDS.set(url, msg.photo[-1].file_id)
+            changed = True
+    if changed:
+        save_file_ids(FILE_IDS)
 
 
 async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -414,26 +1336,263 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await query.message.reply_text(t(user_id, "ask_set"), parse_mode=ParseMode.MARKDOWN)
         return
 
-    # Navigation/filter requires having a search context
-    if "all_models" not in context.user_data:
+    # Navigation/filter/sort state lives in callback_data
+    view = decode_view_token(data)
+    if view is None:
         await query.message.reply_text(t(user_id, "help"))
         return
 
-    if data == "nav:prev":
-        context.user_data["page"] = int(context.user_data.get("page", 0)) - 1
-        await show_current_page(update, context, edit=True)
+    action, set_num, page, pdf_only, sort = view
+    if ALT_CACHE.get(set_num) is None and await throttled(update, "refetch"):
+        return
+    if action == "g" and await throttled(update, "gallery"):
         return
 
-    if data == "nav:next":
-        context.user_data["page"] = int(context.user_data.get("page", 0)) + 1
-        await show_current_page(update, context, edit=True)
+    try:
+        (all_models, count), set_info = await asyncio.gather(
+            get_alternates_with_count(set_num), get_set_info(set_num)
+        )
+    except Exception as e:
+        await query.message.reply_text(t(user_id, "error_api").format(msg=str(e)))
         return
 
-    if data == "filter:toggle":
-        context.user_data["pdf_only"] = not bool(context.user_data.get("pdf_only"))
-        context.user_data["page"] = 0
-        await show_current_page(update, context, edit=True)
+    if action == "g":
+        await send_gallery(update, apply_sort(apply_filter(all_models, pdf_only), sort), page)
+        return
+
+    progress = (len(all_models), count) if count > len(all_models) else None
+    await show_page(
+        query.message, user_id, set_num, all_models, page, pdf_only, sort, progress, set_info, status="truncated"
+    )
+
+
+# ("user" | "chat", id) -> время последнего апдейта; порядок — от давно неактивных к свежим
+SESSIONS: "OrderedDict[tuple, float]" = OrderedDict()
+MEMORY_STATS = {"sweeps": 0, "sessions_expired": 0, "sessions_evicted": 0}
+
+
+async def touch_session(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    now = time.monotonic()
+    keys = []
+    if update.effective_user:
+        keys.append(("user", update.effective_user.id))
+    if update.effective_chat:
+        keys.append(("chat", update.effective_chat.id))
+    for key in keys:
+        SESSIONS[key] = now
+        SESSIONS.move_to_end(key)
+
+
+def session_size(application: Application, key: tuple) -> int:
+    kind, obj_id = key
+    data = application.user_data if kind == "user" else application.chat_data
+    return size_of(data.get(obj_id) or {})
+
+
+def drop_session(application: Application, key: tuple) -> None:
+    SESSIONS.pop(key, None)
+    kind, obj_id = key
+    if kind == "user":
+        application.drop_user_data(obj_id)
+        pending = "_user_ids_to_be_deleted_in_persistence"
+    else:
+        application.drop_chat_data(obj_id)
+        pending = "_chat_ids_to_be_deleted_in_persistence"
+    # drop_*_data запоминает id для удаления из persistence, а очищает этот set только
+    # update_persistence; без persistence он рос бы вместе с числом когда-либо удалённых сессий
+    if application.persistence is None:
+        getattr(application, pending, set()).discard(obj_id)
+
+
+def sweep_memory(application: Application) -> None:
+    """Удаляет сессии, неактивные дольше SESSION_TTL, затем вытесняет самые давно
+    использованные записи (сессии и кэши вместе), пока не уложимся в бюджет."""
+    now = time.monotonic()
+    while SESSIONS:
+        key, seen = next(iter(SESSIONS.items()))
+        if now - seen < SESSION_TTL:
+            break
+        drop_session(application, key)
+        MEMORY_STATS["sessions_expired"] += 1
+
+    sizes = {key: session_size(application, key) for key in SESSIONS}
+    used = ALT_CACHE.bytes + SET_CACHE.bytes + FILE_IDS.bytes + sum(sizes.values())
+    file_ids_evicted = FILE_IDS.evictions
+    while used > MEMORY_BUDGET_MB * 1024 * 1024:
+        candidates = []
+        for cache in (ALT_CACHE, SET_CACHE, FILE_IDS):
+            accessed = cache.oldest_access()
+            if accessed is not None:
+                candidates.append((accessed, cache))
+        if SESSIONS:
+            key, seen = next(iter(SESSIONS.items()))
+            candidates.append((seen, key))
+        if not candidates:
+            break
+
+        _, victim = min(candidates, key=lambda c: c[0])
+        if isinstance(victim, TTLCache):
+            used -= victim.pop_oldest()
+        else:
+            drop_session(application, victim)
+            used -= sizes.pop(victim, 0)
+            MEMORY_STATS["sessions_evicted"] += 1
+
+    if FILE_IDS.evictions != file_ids_evicted:
+        # иначе вытесненные file_id вернутся из файла после перезапуска
+        save_file_ids(FILE_IDS)
+    MEMORY_STATS["sweeps"] += 1
+
+
+async def memory_sweep_job(context: ContextTypes.DEFAULT_TYPE):
+    sweep_memory(context.application)
+
+
+def memory_stats(application: Application) -> Dict[str, Any]:
+    session_bytes = sum(session_size(application, key) for key in SESSIONS)
+    return {
+        "memory_budget_mb": MEMORY_BUDGET_MB,
+        "memory_used_bytes": ALT_CACHE.bytes + SET_CACHE.bytes + FILE_IDS.bytes + session_bytes,
+        "alt_cache_bytes": ALT_CACHE.bytes,
+        "set_cache_bytes": SET_CACHE.bytes,
+        "file_ids": len(FILE_IDS),
+        "file_ids_bytes": FILE_IDS.bytes,
+        "session_bytes": session_bytes,
+        "sessions": len(SESSIONS),
+        **MEMORY_STATS,
+    }
+
+
+class RateLimiter:
+    """Не чаще per_second вызовов в секунду на весь процесс."""
+
+    def __init__(self, per_second: float):
+        self.interval = 1 / per_second
+        self._next = 0.0
+        self._lock = asyncio.Lock()
+
+    async def wait(self) -> None:
+        async with self._lock:
+            now = time.monotonic()
+            if self._next > now:
+                await asyncio.sleep(self._next - now)
+            self._next = max(now, self._next) + self.interval
+
+
+NOTIFY_LIMITER = RateLimiter(NOTIFY_RATE)
+WATCH_STATS = {"watch_polls": 0, "watch_notifications": 0, "watch_dropped": 0}
+
+
+def unsubscribe(set_num: str, chat_id: int) -> None:
+    watch = WATCHES.get(set_num)
+    if watch is None:
         return
+    if chat_id in watch["chats"]:
+        watch["chats"].remove(chat_id)
+    if not watch["chats"]:
+        del WATCHES[set_num]
+
+
+def format_watch_notification(chat_id: int, set_num: str, models: List[Dict[str, Any]]) -> str:
+    lines = [t(chat_id, "watch_new").format(set_num=set_num), ""]
+    for m in models[:PAGE_SIZE_UI]:
+        lines.append(f"• {m.get('name', 'Unnamed')} — {m.get('moc_url', '')}")
+    if len(models) > PAGE_SIZE_UI:
+        lines.append(f"… +{len(models) - PAGE_SIZE_UI}")
+    return "\n".join(lines)
+
+
+async def watch_poll_job(context: ContextTypes.DEFAULT_TYPE):
+    """Опрашивает каждый отслеживаемый набор один раз, сколько бы у него ни было подписчиков."""
+    for set_num in list(WATCHES):
+        try:
+            models = await get_alternates(set_num, refresh=True)
+        except urllib.error.HTTPError as e:
+            if e.code == 404:
+                # набор удалили с Rebrickable — опрашивать его дальше бессмысленно
+                WATCHES.pop(set_num, None)
+                WATCH_STATS["watch_dropped"] += 1
+            continue
+        except Exception:
+            continue
+        WATCH_STATS["watch_polls"] += 1
+
+        watch = WATCHES.get(set_num)
+        if watch is None:
+            continue
+        current = [m.get("set_num") for m in models]
+        if watch["seen"] is None:
+            watch["seen"] = current
+            continue
+
+        seen = set(watch["seen"])
+        new_models = [m for m in models if m.get("set_num") not in seen]
+        if not new_models:
+            continue
+        watch["seen"] = list(watch["seen"]) + [m.get("set_num") for m in new_models]
+
+        for chat_id in list(watch["chats"]):
+            await NOTIFY_LIMITER.wait()
+            try:
+                await context.bot.send_message(
+                    chat_id,
+                    format_watch_notification(chat_id, set_num, new_models),
+                    disable_web_page_preview=True,
+                )
+                WATCH_STATS["watch_notifications"] += 1
+            except Forbidden:
+                # бот заблокирован или удалён из чата
+                unsubscribe(set_num, chat_id)
+            except TelegramError:
+                continue
+
+    save_watches(WATCHES)
+
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """Обрабатывает апдейты параллельно, но апдейты одного пользователя/чата — строго по очереди."""
+
+    def __init__(self, max_workers: int):
+        # базовый семафор ограничивает только очередь; число воркеров ограничиваем после
+        # per-user lock, чтобы ждущие своей очереди апдейты не занимали слоты
+        super().__init__(max_workers * 8)
+        self._workers = asyncio.Semaphore(max_workers)
+        self._locks: Dict[Any, asyncio.Lock] = {}
+        self._waiting: Dict[Any, int] = {}
+
+    @staticmethod
+    def update_key(update: object) -> Any:
+        if isinstance(update, Update):
+            if update.effective_user:
+                return ("user", update.effective_user.id)
+            if update.effective_chat:
+                return ("chat", update.effective_chat.id)
+        return None
+
+    async def do_process_update(self, update: object, coroutine) -> None:
+        key = self.update_key(update)
+        if key is None:
+            async with self._workers:
+                await coroutine
+            return
+
+        lock = self._locks.setdefault(key, asyncio.Lock())
+        self._waiting[key] = self._waiting.get(key, 0) + 1
+        try:
+            async with lock:
+                async with self._workers:
+                    await coroutine
+        finally:
+            self._waiting[key] -= 1
+            if not self._waiting[key]:
+                del self._waiting[key]
+                del self._locks[key]
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
 
 
 # ==========================
@@ -452,16 +1611,28 @@ def main():
         loop = asyncio.new_event_loop()
         asyncio.set_event_loop(loop)
 
-    app = Application.builder().token(BOT_TOKEN).build()
+    app = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .concurrent_updates(PerUserUpdateProcessor(MAX_CONCURRENT_UPDATES))
+        .build()
+    )
 
+    app.add_handler(TypeHandler(Update, touch_session), group=-1)
     app.add_handler(CommandHandler("start", start_cmd))
     app.add_handler(CommandHandler("help", help_cmd))
     app.add_handler(CommandHandler("lang", lang_cmd))
     app.add_handler(CommandHandler("alts", alts_cmd))
+    app.add_handler(CommandHandler("stats", stats_cmd))
+    app.add_handler(CommandHandler("watch", watch_cmd))
+    app.add_handler(CommandHandler("unwatch", unwatch_cmd))
 
     app.add_handler(CallbackQueryHandler(on_callback))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, text_message))
 
+    app.job_queue.run_repeating(memory_sweep_job, interval=MEMORY_SWEEP_INTERVAL, first=MEMORY_SWEEP_INTERVAL)
+    app.job_queue.run_repeating(watch_poll_job, interval=WATCH_INTERVAL, first=WATCH_INTERVAL)
+
     print("Bot is running...")
     app.run_polling(close_loop=False)
 
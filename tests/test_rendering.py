@@ -0,0 +1,40 @@
+from telegram.constants import MessageLimit
+
+from lego_alt_bot import fit_message, format_page, utf16_len
+
+
+def test_utf16_len_counts_astral_characters_twice():
+    assert utf16_len("abc") == 3
+    assert utf16_len("🧩") == 2
+    assert utf16_len("Ж🧩") == 3
+
+
+def test_fit_message_limits_utf16_length_not_code_points():
+    # 2500 символов, но 4000 UTF-16 code units: по len() два блока влезли бы, в Telegram — нет
+    block = "🧩" * 1500 + "x" * 1000
+    text = fit_message("header", [block, block], "footer")
+
+    assert utf16_len(text) <= MessageLimit.MAX_TEXT_LENGTH
+    assert text.count(block) == 1
+    assert text.endswith("…\n\nfooter")
+
+
+def test_format_page_escapes_markdown_v2_specials_in_api_fields():
+    model = {
+        "set_num": "MOC-1",
+        "name": "R2*D2 [big]_(v1.0)!",
+        "designer_name": "brick_master",
+        "num_parts": 1234,
+        "moc_url": "https://rebrickable.com/mocs/MOC-1/brick_master/r2-d2-(v1.0)/",
+        "moc_has_building_instructions": True,
+    }
+    set_info = {"name": "Tow Truck #2", "year": 2020, "num_parts": 900}
+
+    text = format_page(1, "10497-1", [model], 0, False, set_info=set_info)
+
+    assert r"*R2\*D2 \[big\]\_\(v1\.0\)\!*" in text
+    assert r"brick\_master" in text
+    assert r"https://rebrickable\.com/mocs/MOC\-1/brick\_master/r2\-d2\-\(v1\.0\)/" in text
+    assert r"Tow Truck \#2" in text
+    assert r"10497\-1" in text
+    assert "R2*D2" not in text
@@ -0,0 +1,76 @@
+import asyncio
+import datetime
+
+from telegram import Chat, Message, Update, User
+
+from lego_alt_bot import PerUserUpdateProcessor
+
+
+def make_update(update_id: int, user_id: int) -> Update:
+    message = Message(
+        message_id=update_id,
+        date=datetime.datetime.now(datetime.timezone.utc),
+        chat=Chat(id=user_id, type=Chat.PRIVATE),
+        from_user=User(id=user_id, first_name="test", is_bot=False),
+        text=f"msg {update_id}",
+    )
+    return Update(update_id=update_id, message=message)
+
+
+def test_updates_of_one_user_run_in_order_and_users_overlap():
+    async def scenario():
+        processor = PerUserUpdateProcessor(max_workers=4)
+        finished = {1: [], 2: []}
+        running = set()
+        overlapped = []
+
+        async def handle(user_id: int, update_id: int, delay: float):
+            running.add(user_id)
+            if len(running) > 1:
+                overlapped.append(update_id)
+            await asyncio.sleep(delay)
+            running.discard(user_id)
+            finished[user_id].append(update_id)
+
+        jobs = []
+        # первые апдейты медленнее последующих: без per-user очереди порядок бы перемешался
+        for i, delay in enumerate((0.05, 0.01, 0.02, 0.0)):
+            for user_id in (1, 2):
+                update_id = user_id * 100 + i
+                update = make_update(update_id, user_id)
+                jobs.append(processor.process_update(update, handle(user_id, update_id, delay)))
+        await asyncio.gather(*jobs)
+        return processor, finished, overlapped
+
+    processor, finished, overlapped = asyncio.run(scenario())
+
+    assert finished[1] == [100, 101, 102, 103]
+    assert finished[2] == [200, 201, 202, 203]
+    assert overlapped, "updates of different users should be processed concurrently"
+    assert processor._locks == {}
+    assert processor._waiting == {}
+
+
+def test_worker_limit_applies_across_users():
+    async def scenario():
+        processor = PerUserUpdateProcessor(max_workers=2)
+        active = 0
+        peak = 0
+
+        async def handle():
+            nonlocal active, peak
+            active += 1
+            peak = max(peak, active)
+            await asyncio.sleep(0.01)
+            active -= 1
+
+        await asyncio.gather(
+            *(processor.process_update(make_update(i, 1000 + i), handle()) for i in range(6))
+        )
+        return processor, peak
+
+    processor, peak = asyncio.run(scenario())
+
+    assert peak == 2
+    assert processor._locks == {}
+    assert processor._waiting == {}